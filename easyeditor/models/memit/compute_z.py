@@ -11,6 +11,8 @@ from .memit_hparams import MEMITHyperParams
 from ..rome.layer_stats import layer_stats
 
 COV_CACHE = {}
+# Compiled rewriting loss head: None until first use, False once compiling has failed
+COMPILED_LOSS_HEAD = None
 
 
 # from .memit_main import get_cov
@@ -127,9 +129,29 @@ def compute_z(
 ):
     """
     Computes the value (right) vector for the rank-1 update.
-    Runs a simple optimization procedure.
+    Thin wrapper around `compute_z_batch` for a single request.
+    """
+
+    targets, probs, inits = compute_z_batch(model, tok, [request], hparams, layer, context_templates)
+
+    return targets[0], probs[0], inits[0]
+
+
+def compute_z_batch(
+        model: AutoModelForCausalLM,
+        tok: AutoTokenizer,
+        requests: List[Dict],
+        hparams: MEMITHyperParams,
+        layer: int,
+        context_templates: List[str],
+):
+    """
+    Computes the value (right) vectors for a batch of requests.
+    Runs a single optimization procedure over a [batch, hidden] latent,
+    where the loss of every request only sees its own prompts.
+    Also returns the unedited layer outputs at the lookup tokens, which
+    are the current z values of the requests.
     """
-    global w_init_dic
     # Get model parameters
     lm_w, ln_f = (
         nethook.get_parameter(model, f"{hparams.lm_head_module}.weight").T,
@@ -140,57 +162,73 @@ def compute_z(
     except LookupError as _:
         lm_b = next(model.parameters()).new_zeros(model.config.vocab_size)
 
-    print("Computing right vector (v)")
-
-    # Tokenize target into list of int token IDs
-    target_ids = tok(request["target_new"], return_tensors="pt").to(f"cuda:{hparams.device}")[
-        "input_ids"
-    ][0]
-
-    if target_ids[0] == tok.bos_token_id or target_ids[0] == tok.unk_token_id:
-        target_ids = target_ids[1:]
-    # Compile list of rewriting and KL x/y pairs
-    rewriting_prompts, kl_prompts = [
-        context.format(request["prompt"]) + tok.decode(target_ids[:-1])
-        for context_types in context_templates
-        for context in context_types
-    ], ["{} is a"]
+    print(f"Computing right vector (v) for {len(requests)} request(s)")
+
+    device = f"cuda:{hparams.device}"
+    n_requests = len(requests)
+
+    # Compile list of rewriting and KL x/y pairs, remembering which request owns each prompt
+    rewriting_prompts, rewriting_owner, target_ids_list = [], [], []
+    for b, request in enumerate(requests):
+        # Tokenize target into list of int token IDs
+        target_ids = tok(request["target_new"], return_tensors="pt").to(device)["input_ids"][0]
+
+        if target_ids[0] == tok.bos_token_id or target_ids[0] == tok.unk_token_id:
+            target_ids = target_ids[1:]
+        target_ids_list.append(target_ids)
+
+        cur_prompts = [
+            context.format(request["prompt"]) + tok.decode(target_ids[:-1])
+            for context_types in context_templates
+            for context in context_types
+        ]
+        rewriting_prompts += cur_prompts
+        rewriting_owner += [b] * len(cur_prompts)
+    kl_prompts = ["{} is a"] * n_requests
     all_prompts = rewriting_prompts + kl_prompts
+    owner = rewriting_owner + list(range(n_requests))
+    all_subjects = [requests[b]["subject"] for b in owner]
 
     input_tok = tok(
-        [prompt.format(request["subject"]) for prompt in all_prompts],
+        [prompt.format(subject) for prompt, subject in zip(all_prompts, all_subjects)],
         return_tensors="pt",
         padding=True,
-    ).to(f"cuda:{hparams.device}")
+    ).to(device)
 
     # Compute rewriting targets
-    rewriting_targets = torch.tensor(-100, device=f"cuda:{hparams.device}").repeat(
+    rewriting_targets = torch.tensor(-100, device=device).repeat(
         len(rewriting_prompts), *input_tok["input_ids"].shape[1:]
     )
-    for i in range(len(rewriting_prompts)):
+    for i, b in enumerate(rewriting_owner):
         ex_len = input_tok["attention_mask"][i].sum()
+        target_ids = target_ids_list[b]
         rewriting_targets[i, ex_len - len(target_ids): ex_len] = target_ids
+    target_lens = torch.tensor([len(target_ids_list[b]) for b in rewriting_owner], device=device)
+    rewriting_owner_t = torch.tensor(rewriting_owner, device=device)
+    prompts_per_request = torch.bincount(rewriting_owner_t, minlength=n_requests)
 
     # Compute indices of the tokens where the fact is looked up
     lookup_idxs = [
         find_fact_lookup_idx(
-            prompt, request["subject"], tok, hparams.fact_token, verbose=(i == 0)
+            prompt, subject, tok, hparams.fact_token, verbose=(i == 0)
         )
-        for i, prompt in enumerate(all_prompts)
+        for i, (prompt, subject) in enumerate(zip(all_prompts, all_subjects))
     ]
+    # First rewriting prompt of every request is the clean "{}" template
+    first_rows = [rewriting_owner.index(b) for b in range(n_requests)]
 
     # Finalize rewrite and loss layers
     loss_layer = max(hparams.v_loss_layer, layer)
     print(f"Rewrite layer is {layer}")
     print(f"Tying optimization objective to {loss_layer}")
 
-    # Set up an optimization over a latent vector that, when output at the
-    # rewrite layer, i.e. hypothesized fact lookup location, will induce the
+    # Set up an optimization over a latent vector per request that, when output at
+    # the rewrite layer, i.e. hypothesized fact lookup location, will induce the
     # target token to be predicted at the final layer.
     if hasattr(model.config, 'n_embd'):
-        delta = torch.zeros((model.config.n_embd,), requires_grad=True, device=f"cuda:{hparams.device}")
+        delta = torch.zeros((n_requests, model.config.n_embd), requires_grad=True, device=device)
     elif hasattr(model.config, 'hidden_size'):
-        delta = torch.zeros((model.config.hidden_size,), requires_grad=True, device=f"cuda:{hparams.device}")
+        delta = torch.zeros((n_requests, model.config.hidden_size), requires_grad=True, device=device)
     else:
         raise NotImplementedError
     target_init, kl_distr_init = None, None
@@ -204,15 +242,17 @@ def compute_z(
             if target_init is None:
                 print("Recording initial value of v*")
                 # Initial value is recorded for the clean sentence
-                target_init = cur_out[0][0, lookup_idxs[0]].detach().clone()
+                target_init = torch.stack(
+                    [cur_out[0][row, lookup_idxs[row]] for row in first_rows], dim=0
+                ).detach().clone()
 
             # Add intervened delta
             for i, idx in enumerate(lookup_idxs):
 
                 if len(lookup_idxs) != len(cur_out[0]):
-                    cur_out[0][idx, i, :] += delta.to(cur_out[0].device)
+                    cur_out[0][idx, i, :] += delta[owner[i]].to(cur_out[0].device)
                 else:
-                    cur_out[0][i, idx, :] += delta.to(cur_out[0].device)
+                    cur_out[0][i, idx, :] += delta[owner[i]].to(cur_out[0].device)
 
         return cur_out
 
@@ -220,8 +260,12 @@ def compute_z(
     opt = torch.optim.Adam([delta], lr=hparams.v_lr)
     nethook.set_requires_grad(False, model)
 
+    # Rows stop being tracked once their own loss has converged
+    active = torch.ones(n_requests, dtype=torch.bool, device=device)
+    final_delta = torch.zeros_like(delta, requires_grad=False)
+    first_probs, last_probs = None, [None] * n_requests
+
     # Execute optimization
-    prob_list = []
     for it in range(hparams.v_num_grad_steps):
         opt.zero_grad()
 
@@ -256,35 +300,49 @@ def compute_z(
             output = torch.transpose(output, 0, 1)
         full_repr = output[:len(rewriting_prompts)]
 
-        log_probs = torch.log_softmax(ln_f(full_repr) @ lm_w.to(full_repr.device) + lm_b.to(full_repr.device), dim=2)
-        loss = torch.gather(
-            log_probs,
-            2,
-            torch.where(rewriting_targets != -100, rewriting_targets, 0).unsqueeze(2).to(log_probs.device),
-        ).squeeze(2)
-        mask = (rewriting_targets != -100).float()
-
-        # Aggregate total losses
-        nll_loss_each = -(loss * mask.to(loss.device)).sum(1) / target_ids.size(0)
-        nll_loss = nll_loss_each.mean()
+        # Aggregate total losses per request
+        nll_loss_each = -fast_rewriting_log_likelihood(
+            hparams,
+            full_repr,
+            ln_f,
+            lm_w.to(full_repr.device),
+            lm_b.to(full_repr.device),
+            rewriting_targets.to(full_repr.device),
+        ) / target_lens.to(full_repr.device)
+        nll_loss = torch.zeros(n_requests, device=nll_loss_each.device).index_add(
+            0, rewriting_owner_t.to(nll_loss_each.device), nll_loss_each
+        ) / prompts_per_request.to(nll_loss_each.device)
         kl_loss = hparams.kl_factor * torch.nn.functional.kl_div(
-            kl_distr_init, kl_log_probs, log_target=True, reduction="batchmean"
-        )
-        # torch.norm(target_init.to(delta.device)) ** 2
+            kl_distr_init, kl_log_probs, log_target=True, reduction="none"
+        ).sum(1)
         "=========================================================================="
         weight_decay = hparams.v_weight_decay * (
-            torch.norm(delta) / torch.norm(target_init.to(delta.device)) ** 2
+            torch.norm(delta, dim=1) / torch.norm(target_init.to(delta.device), dim=1) ** 2
         )
         "=========================================================================="
-        loss = nll_loss + kl_loss.to(nll_loss.device) + weight_decay.to(nll_loss.device)
-        prob = torch.exp(-nll_loss_each).mean().item()
-        prob_list.append(prob)
+        loss_each = nll_loss + kl_loss.to(nll_loss.device) + weight_decay.to(nll_loss.device)
+        prob = torch.zeros(n_requests, device=nll_loss_each.device).index_add(
+            0, rewriting_owner_t.to(nll_loss_each.device), torch.exp(-nll_loss_each)
+        ) / prompts_per_request.to(nll_loss_each.device)
+        loss = loss_each.sum()
+
+        # Record the latent that produced this loss for every still-active request
+        with torch.no_grad():
+            final_delta[active] = delta[active]
+        prob_values, loss_values = prob.tolist(), loss_each.tolist()
+        if first_probs is None:
+            first_probs = prob_values
+        for b, is_active in enumerate(active.tolist()):
+            if is_active:
+                last_probs[b] = prob_values[b]
         print(
-            f"loss {np.round(loss.item(), 3)} = {np.round(nll_loss.item(), 3)} + {np.round(kl_loss.item(), 3)} + {np.round(weight_decay.item(), 3)} "
-            f"avg prob of [{request['target_new']}] "
-            f"{prob}"
+            f"loss {np.round(loss.item(), 3)} = {np.round(nll_loss.sum().item(), 3)} + "
+            f"{np.round(kl_loss.sum().item(), 3)} + {np.round(weight_decay.sum().item(), 3)} "
+            f"avg prob of {[request['target_new'] for request in requests]} "
+            f"{prob_values}"
         )
-        if loss < 5e-2:
+        active &= torch.tensor(loss_values, device=device) >= 5e-2
+        if not active.any():
             break
 
         if it == hparams.v_num_grad_steps - 1:
@@ -295,18 +353,60 @@ def compute_z(
         opt.step()
 
         # Project within L2 ball
-        max_norm = hparams.clamp_norm_factor * target_init.norm()
-        if delta.norm() > max_norm.to(delta.device):
-            with torch.no_grad():
-                delta[...] = delta * max_norm.to(delta.device) / delta.norm()
+        max_norm = hparams.clamp_norm_factor * target_init.norm(dim=1)
+        with torch.no_grad():
+            scale = (max_norm.to(delta.device) / delta.norm(dim=1)).clamp(max=1.0)
+            delta[...] = delta * scale.unsqueeze(1)
 
-    target = target_init.to(delta.device) + delta
+    target = target_init.to(final_delta.device) + final_delta
     print(
-        f"Init norm {target_init.norm()} | Delta norm {delta.norm()} | Target norm {target.norm()}"
+        f"Init norm {target_init.norm(dim=1)} | Delta norm {final_delta.norm(dim=1)} | Target norm {target.norm(dim=1)}"
     )
-    print(f"editing successful: {(prob_list[-1] - prob_list[0]) > 0}")
+    print(f"editing successful: {[(last - first) > 0 for first, last in zip(first_probs, last_probs)]}")
+
+    return target, [[first, last] for first, last in zip(first_probs, last_probs)], target_init
+
+
+def rewriting_log_likelihood(
+        full_repr: torch.Tensor,
+        ln_f: torch.nn.Module,
+        lm_w: torch.Tensor,
+        lm_b: torch.Tensor,
+        rewriting_targets: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Computes the summed log-likelihood of the target tokens of every rewriting prompt.
+    """
+
+    log_probs = torch.log_softmax(ln_f(full_repr) @ lm_w + lm_b, dim=2)
+    loss = torch.gather(
+        log_probs,
+        2,
+        torch.where(rewriting_targets != -100, rewriting_targets, 0).unsqueeze(2),
+    ).squeeze(2)
+    mask = (rewriting_targets != -100).float()
+
+    return (loss * mask).sum(1)
 
-    return target, [prob_list[0], prob_list[-1]]
+
+def fast_rewriting_log_likelihood(hparams: MEMITHyperParams, *args) -> torch.Tensor:
+    """
+    Runs `rewriting_log_likelihood` through torch.compile when `hparams.compile_loss_head`
+    is set, falling back to eager execution when compilation is unsupported or fails.
+    """
+    global COMPILED_LOSS_HEAD
+
+    if hparams.compile_loss_head and COMPILED_LOSS_HEAD is not False:
+        try:
+            if COMPILED_LOSS_HEAD is None:
+                # Dynamic shapes avoid a recompile per prompt length
+                COMPILED_LOSS_HEAD = torch.compile(rewriting_log_likelihood, dynamic=True)
+            return COMPILED_LOSS_HEAD(*args)
+        except Exception as e:
+            print(f"Compiling the loss head failed due to {e}. Falling back to eager mode...")
+            COMPILED_LOSS_HEAD = False
+
+    return rewriting_log_likelihood(*args)
 
 
 def get_module_input_output_at_words(
@@ -42,6 +42,15 @@ class MEMITHyperParams(HyperParams):
     max_length: int = 40
     batch_size: int = 1
     model_parallel: bool = False
+    v_batch_size: int = 1
+    verbose: bool = False
+    # Keep right^-1 per layer across sequential edits and update it with Woodbury.
+    # Costs one extra d x d fp64 tensor per layer on the GPU
+    cache_right_inv: bool = False
+    # Number of Woodbury updates after which the cached inverse is rebuilt
+    right_inv_refresh: int = 100
+    # Run the loss head of compute_z through torch.compile
+    compile_loss_head: bool = False
 
     @classmethod
     def from_hparams(cls, hparams_name_or_path: str):
@@ -1,4 +1,5 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from pathlib import Path
 from typing import Any, Dict, List, Optional, Tuple
@@ -13,12 +14,17 @@ from ...util.generate import generate_fast
 from ...util.globals import *
 
 from .compute_ks import compute_ks
-from .compute_z import compute_z, get_module_input_output_at_words, find_fact_lookup_idx, get_cov
+from .compute_z import compute_z_batch, get_module_input_output_at_words, find_fact_lookup_idx, get_cov
 from .memit_hparams import MEMITHyperParams
 
 # Cache variable(s)
 CONTEXT_TEMPLATES_CACHE = None
 cache_kvs = {}
+# Number of Woodbury updates applied to each cached `right` inverse since it was last rebuilt
+right_inv_age = {}
+
+# Strips format braces from generated context templates in a single pass
+_BRACE_TT = str.maketrans({"{": " ", "}": " "})
 
 
 def get_cache(name):
@@ -27,15 +33,19 @@ def get_cache(name):
     return cache_kvs[name]
 
 
-def upd_cache(name, w):
+def upd_cache_mm(name, a, b):
+    """
+    Accumulates the product a @ b into the cache, fusing the GEMM and the
+    accumulation into a single addmm call.
+    """
     global cache_kvs
 
     if name in cache_kvs:
         with torch.no_grad():
-            cache_kvs[name] = cache_kvs[name] + w.to(cache_kvs[name].device)
+            cache_kvs[name].addmm_(a.to(cache_kvs[name].device), b.to(cache_kvs[name].device))
     else:
         with torch.no_grad():
-            cache_kvs[name] = w
+            cache_kvs[name] = a @ b.to(a.device)
 
 
 def apply_memit_to_model(
@@ -65,12 +75,13 @@ def apply_memit_to_model(
     with torch.no_grad():
         for w_name, upd_matrix in deltas.items():
             w = nethook.get_parameter(model, w_name)
-            upd_matrix = upd_matrix_match_shape(upd_matrix, w.shape)
+            upd_matrix = upd_matrix_match_shape(upd_matrix, w.shape).to(w.device)
 
-            delta_nom[w_name] = torch.norm(upd_matrix, p=1).item() / upd_matrix.numel()
+            # Mean absolute value on the device, as a single fused abs + reduce
+            delta_nom[w_name] = upd_matrix.abs().mean().item()
             if return_orig_weights and w_name not in weights_copy:
                 weights_copy[w_name] = w.detach().clone()
-            w[...] += upd_matrix.to(w.device).float()
+            w.add_(upd_matrix)
 
     print(f"New weights successfully inserted into {list(deltas.keys())}")
 
@@ -93,19 +104,24 @@ def execute_memit(
     """
 
     deltas = {}
+    # Device that holds the z's, the D4S caches and the solve
+    solve_dev = torch.device(f"cuda:{hparams.device}")
 
-    # Update target and print info
-    requests = deepcopy(requests)
-    for i, request in enumerate(requests):
-        if request["target_new"][0] != " ":
-            # Space required for correct tokenization
-            requests[i]["target_new"] = " " + request["target_new"]
-
+    # Update target and print info. Only the prompt and target strings change,
+    # so shallow copies of the requests are enough
+    for request in requests:
         if '{}' not in request['prompt']:
-            assert request['subject'] in request['prompt'] or \
-                   print(f"Subject:{request['subject']} do not exist in prompt: {request['prompt']}")
-
-            requests[i]['prompt'] = requests[i]['prompt'].replace(requests[i]['subject'], '{}')
+            assert request['subject'] in request['prompt'], \
+                f"Subject:{request['subject']} do not exist in prompt: {request['prompt']}"
+    requests = [
+        {
+            **request,
+            # Space required for correct tokenization
+            "target_new": request["target_new"] if request["target_new"][0] == " " else " " + request["target_new"],
+            "prompt": request["prompt"] if '{}' in request["prompt"] else request["prompt"].replace(request["subject"], '{}'),
+        }
+        for request in requests
+    ]
 
     for request in requests[:10]:
         print(
@@ -120,74 +136,105 @@ def execute_memit(
         )
         for layer in hparams.layers
     }
-    # Save old weights for future restoration
-    weights_copy = {k: v.detach().clone() for k, v in weights.items()}
+    # Save old weights for future restoration. The last layer is never written to,
+    # since no later layer's keys depend on it
+    weights_copy = {
+        k: v.detach().clone() for k, v in weights.items()
+        if k != f"{hparams.rewrite_module_tmp.format(hparams.layers[-1])}.weight"
+    }
 
     # Compute z for final layer
     context_templates = get_context_templates(model, tok)
     z_layer = hparams.layers[-1]
-    z_list = []
+    hidden_size = model.config.n_embd if hasattr(model.config, 'n_embd') else model.config.hidden_size
+    # Target and current z of every request, filled in place; hidden_dim * batch_size
+    zs = torch.empty((hidden_size, len(requests)), dtype=torch.float32, device=solve_dev)
+    cur_zs = torch.empty_like(zs)
+    cached = []
     prob_list = []
-    for request in requests:
-        # Retrieve k/v pair if already stored in cache
-        cache_fname = (
-            Path(
-                str(cache_template).format(
-                    z_layer, hparams.clamp_norm_factor, request["case_id"]
-                )
+    # compute_z_batch records the current z at its lookup token, which only matches the
+    # token read by get_module_input_output_at_words for the subject_* strategies
+    reuse_cur_zs = hparams.fact_token.startswith("subject_")
+    cache_fnames = [
+        Path(
+            str(cache_template).format(
+                z_layer, hparams.clamp_norm_factor, request["case_id"]
             )
-            if cache_template is not None
-            else None
         )
-        data_loaded = False
-        if (
-                cache_fname is not None  # Require cache template
-                and cache_fname.exists()  # Cache file must exist
-        ):
-            try:
-                data = np.load(cache_fname)
-                z_list.append(torch.from_numpy(data["v_star"]).to(f"cuda:{hparams.device}"))
-                data_loaded = True
-            except Exception as e:
-                print(f"Error reading cache file due to {e}. Recomputing...")
-
-        # Compute k/v pair if not loaded from cache
-        if not data_loaded:
-            cur_z, prob = compute_z(
+        if cache_template is not None
+        else None
+        for request in requests
+    ]
+    saves = []
+
+    def compute_uncached(uncached, io_pool):
+        # Compute k/v pairs not loaded from cache, one mini-batch of requests at a time
+        for start in range(0, len(uncached), hparams.v_batch_size):
+            batch = uncached[start: start + hparams.v_batch_size]
+            batch_zs, probs, batch_cur_zs = compute_z_batch(
                 model,
                 tok,
-                request,
+                [requests[i] for i in batch],
                 hparams,
                 z_layer,
                 context_templates,
             )
-            prob_list.append(prob)
-            z_list.append(cur_z)
-
-            if cache_fname is not None:
-                cache_fname.parent.mkdir(exist_ok=True, parents=True)
-                np.savez(
-                    cache_fname,
-                    **{
-                        "v_star": cur_z.detach().cpu().numpy(),
-                    },
-                )
-                print(f"Cached k/v pair at {cache_fname}")
-    zs = torch.stack(z_list, dim=1)
-    # hidden_dim * batch_size
-
-    # Compute residual error
-    cur_zs = get_module_input_output_at_words(
-        model,
-        tok,
-        z_layer,
-        context_templates=[request["prompt"] for request in requests],
-        words=[request["subject"] for request in requests],
-        module_template=hparams.layer_module_tmp,
-        fact_token_strategy=hparams.fact_token,
-        track='out'
-    ).T
-    targets = zs - cur_zs.to(zs.device)
+            prob_list.extend(probs)
+
+            for i, cur_z, cur_z_out in zip(batch, batch_zs, batch_cur_zs):
+                zs[:, i] = cur_z
+                if reuse_cur_zs:
+                    cur_zs[:, i] = cur_z_out
+
+                if cache_fnames[i] is not None:
+                    cache_fnames[i].parent.mkdir(exist_ok=True, parents=True)
+                    # Only the device-to-host copy blocks, the disk write happens in the background
+                    saves.append((
+                        cache_fnames[i],
+                        io_pool.submit(np.savez, cache_fnames[i], v_star=cur_z.detach().cpu().numpy()),
+                    ))
+
+    with ThreadPoolExecutor(max_workers=4) as io_pool:
+        # Retrieve k/v pairs already stored in cache in the background, while the
+        # requests without a cache file are being optimized
+        loads = {
+            i: io_pool.submit(load_v_star, cache_fname)
+            for i, cache_fname in enumerate(cache_fnames)
+            if cache_fname is not None and cache_fname.exists()
+        }
+        compute_uncached([i for i in range(len(requests)) if i not in loads], io_pool)
+
+        failed = []
+        for i, future in loads.items():
+            try:
+                zs[:, i] = torch.from_numpy(future.result()).to(zs)
+                cached.append(i)
+            except Exception as e:
+                print(f"Error reading cache file due to {e}. Recomputing...")
+                failed.append(i)
+        compute_uncached(failed, io_pool)
+
+        # Wait for the background writes, surfacing their errors
+        for cache_fname, future in saves:
+            future.result()
+            print(f"Cached k/v pair at {cache_fname}")
+
+    # Compute residual error. When compute_z_batch already recorded the current z of the
+    # requests it optimized, only those loaded from cache need a forward pass
+    missing = cached if reuse_cur_zs else list(range(len(requests)))
+    if len(missing) > 0:
+        missing_zs = get_module_input_output_at_words(
+            model,
+            tok,
+            z_layer,
+            context_templates=[requests[i]["prompt"] for i in missing],
+            words=[requests[i]["subject"] for i in missing],
+            module_template=hparams.layer_module_tmp,
+            fact_token_strategy=hparams.fact_token,
+            track='out'
+        )
+        cur_zs[:, missing] = missing_zs.T.to(cur_zs)
+    targets = zs - cur_zs
 
     # Insert
     for i, layer in enumerate(hparams.layers):
@@ -199,57 +246,105 @@ def execute_memit(
         # hidden_dim * batch_size
         print(f"Writing {layer_ks.size(1)} key/value pair(s) into layer {layer}")
 
-        print("z error", torch.linalg.norm(targets, dim=0).mean())
+        if hparams.verbose:
+            # Printing a device tensor forces a sync, so only do it when asked to
+            print("z error", torch.linalg.norm(targets, dim=0).mean())
 
         repeat_factor = (layer_ks.size(1) // targets.size(1))
+        # Single move of the keys onto the solve device, everything below is already there
         layer_ks, targets = (
-            layer_ks.double(),
+            layer_ks.to(solve_dev, torch.float64),
             targets.double(),
         )
         targets = targets.repeat_interleave(repeat_factor, dim=1)
-        r_cache = targets @ layer_ks.T.to(targets.device)
-        upd_cache(name=weight_name + "r_cache", w=r_cache)
-
-        # Load covariance matrix
-        force_recompute = False
-        # force_recompute = layer != hparams.layers[0]
-        cov = get_cov(
-            model,
-            tok,
-            hparams.rewrite_module_tmp.format(layer),
-            hparams.mom2_dataset,
-            hparams.mom2_n_samples
-            if not force_recompute
-            else hparams.mom2_n_samples // 10,
-            hparams.mom2_dtype,
-            force_recompute=force_recompute,
-            hparams=hparams
-        )
+        upd_cache_mm(name=weight_name + "r_cache", a=targets, b=layer_ks.T)
+        upd_cache_mm(name=weight_name + "right_cache", a=layer_ks, b=layer_ks.T)
 
-        right_cache = layer_ks.to(cov.device) @ layer_ks.to(cov.device).T
-        upd_cache(name=weight_name + "right_cache", w=right_cache)
-
-        r = get_cache(name=weight_name + "r_cache").detach().clone()
-        right = get_cache(name=weight_name + "right_cache").detach().clone()
-        right = right + hparams.mom2_update_weight * cov.double().to(right.device)
-        resid = r / (len(hparams.layers) - i)  # Distribute residual across layers
+        # The caches are only read below, so no defensive copy is needed
+        r = get_cache(name=weight_name + "r_cache")
         with torch.no_grad():
-            upd_matrix = torch.linalg.solve(right, resid, left=False)
+            if (
+                    hparams.cache_right_inv
+                    and weight_name + "right_inv" in cache_kvs
+                    and right_inv_age[weight_name] < hparams.right_inv_refresh
+                    and 3 * layer_ks.size(1) < layer_ks.size(0)
+            ):
+                # Since the last edit, `right` has only gained the rank-k term K @ K.T: update
+                # its cached inverse with Woodbury instead of refactorizing (O(d^2 k) vs O(d^3))
+                right_inv = get_cache(name=weight_name + "right_inv")
+                u = right_inv @ layer_ks
+                s = torch.eye(layer_ks.size(1), dtype=layer_ks.dtype, device=solve_dev) + layer_ks.T @ u
+                right_inv = right_inv - u @ torch.linalg.solve(s, u.T)
+                # Keep rounding error from breaking the symmetry of the inverse
+                right_inv = (right_inv + right_inv.T).div_(2)
+                right_inv_age[weight_name] += 1
+                upd_matrix = r @ right_inv
+            else:
+                # Load covariance matrix
+                force_recompute = False
+                # force_recompute = layer != hparams.layers[0]
+                cov = get_cov(
+                    model,
+                    tok,
+                    hparams.rewrite_module_tmp.format(layer),
+                    hparams.mom2_dataset,
+                    hparams.mom2_n_samples
+                    if not force_recompute
+                    else hparams.mom2_n_samples // 10,
+                    hparams.mom2_dtype,
+                    force_recompute=force_recompute,
+                    hparams=hparams
+                )
+
+                right_cache = get_cache(name=weight_name + "right_cache")
+                right = torch.add(right_cache, cov.double(), alpha=hparams.mom2_update_weight)
+                del cov
+                if hparams.cache_right_inv:
+                    # (Re)build the inverse from scratch, which also drops the error
+                    # accumulated by the Woodbury updates
+                    try:
+                        # `right` is SPD, so invert it through its Cholesky factor
+                        right_inv = torch.cholesky_inverse(torch.linalg.cholesky(right))
+                    except torch.linalg.LinAlgError:
+                        right_inv = torch.linalg.inv(right)
+                    right_inv_age[weight_name] = 0
+                    upd_matrix = r @ right_inv
+                else:
+                    try:
+                        # `right` is SPD, so solve upd @ right = r through its Cholesky factor.
+                        # Factor and solve in fp32, then correct with one step of iterative
+                        # refinement whose residual is computed in fp64
+                        L = torch.linalg.cholesky(right.float())
+                        upd_matrix = torch.cholesky_solve(r.T.float(), L).T.double()
+                        upd_matrix += torch.cholesky_solve((r - upd_matrix @ right).T.float(), L).T
+                        del L
+                    except torch.linalg.LinAlgError:
+                        upd_matrix = torch.linalg.solve(right, r, left=False)
+                del right
+            if hparams.cache_right_inv:
+                cache_kvs[weight_name + "right_inv"] = right_inv
+            else:
+                # `right_cache` moves on without the inverse, so drop it rather than leave it stale
+                cache_kvs.pop(weight_name + "right_inv", None)
+            # Distribute residual across layers. `r` is the cache and must not be scaled in
+            # place, so scale the solution instead. The update itself is stored and applied in fp32
+            upd_matrix = upd_matrix.div_(len(hparams.layers) - i).float()
 
         # Adjust update matrix shape
         upd_matrix = upd_matrix_match_shape(upd_matrix, weights[weight_name].shape)
 
-        print("orig norm", torch.linalg.norm(weights[weight_name]))
-        print("upd norm", torch.linalg.norm(upd_matrix))
+        if hparams.verbose:
+            print("orig norm", torch.linalg.norm(weights[weight_name]))
+            print("upd norm", torch.linalg.norm(upd_matrix))
 
         # Update model weights and record desired changes in `delta` variable
         with torch.no_grad():
-            weights[weight_name][...] = weights_copy[weight_name] + upd_matrix.to(
-                weights_copy[weight_name].device).float()
+            # Keys of the later layers are computed on the model edited so far
+            if weight_name in weights_copy:
+                weights[weight_name].add_(upd_matrix.to(weights[weight_name].device))
             deltas[weight_name] = upd_matrix.detach().cpu()
 
         # Clear GPU memory
-        cov.cpu()
         for x in [layer_ks, cur_zs, targets]:
             x.cpu()
             del x
@@ -257,14 +352,23 @@ def execute_memit(
 
     # Restore state of original model
     with torch.no_grad():
-        for k, v in weights.items():
-            v[...] = weights_copy[k]
+        for k, v in weights_copy.items():
+            weights[k].copy_(v, non_blocking=True)
 
     print(f"Deltas successfully computed for {list(weights.keys())}")
 
     return deltas, prob_list
 
 
+def load_v_star(cache_fname: Path) -> np.ndarray:
+    """
+    Reads a cached v* vector, fully materialized so it can be used off the I/O thread.
+    """
+
+    with np.load(cache_fname) as data:
+        return data["v_star"]
+
+
 def upd_matrix_match_shape(matrix: torch.Tensor, shape: torch.Size) -> torch.Tensor:
     """
     GPT-2 and GPT-J have transposed weight representations.
@@ -288,7 +392,7 @@ def get_context_templates(model, tok):
     if CONTEXT_TEMPLATES_CACHE is None:
         CONTEXT_TEMPLATES_CACHE = [["{}"]] + [
             [
-                f.replace("{", " ").replace("}", " ") + ". {}"
+                f.translate(_BRACE_TT) + ". {}"
                 for f in generate_fast(
                 model,
                 tok,